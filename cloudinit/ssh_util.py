@@ -6,8 +6,13 @@
 #
 # This file is part of cloud-init. See LICENSE file for license information.
 
+import functools
 import os
 import pwd
+import re
+import stat
+import sys
+from errno import ELOOP, ENOENT, ENOTDIR
 
 from cloudinit import log as logging
 from cloudinit import util
@@ -56,6 +61,9 @@ VALID_KEY_TYPES = (
     "ssh-xmss@openssh.com",
 )
 
+# Set form of VALID_KEY_TYPES for constant time keytype checks while parsing
+_VALID_KEY_TYPES_SET = frozenset(VALID_KEY_TYPES)
+
 _DISABLE_USER_SSH_EXIT = 142
 
 DISABLE_USER_OPTS = (
@@ -64,8 +72,29 @@ DISABLE_USER_OPTS = (
     " rather than the user \\\"$DISABLE_USER\\\".\';echo;sleep 10;"
     "exit " + str(_DISABLE_USER_SSH_EXIT) + "\"")
 
+# Tokens expanded in AuthorizedKeysFile, see render_authorizedkeysfile_paths.
+_AUTHKEYSFILE_TOKEN_RE = re.compile(r'%[hu%]')
+
+# Parsed sshd_config maps, keyed by filename, see parse_ssh_config_map.
+_SSHD_CFG_MAP_CACHE = {}
+
+# Errors meaning an authorized_keys path does not lead to a file; such paths
+# are skipped quietly.
+_NOT_A_FILE_ERRNOS = (ENOENT, ENOTDIR, ELOOP)
+
+# Lines longer than this are not memoized by AuthKeyLineParser.parse, so a
+# single oversized entry cannot pin an arbitrary amount of memory in the cache.
+_PARSE_CACHE_MAX_LINE = 8192
+
+# Matches the leading options field of an authorized_keys entry: everything
+# up to the first space or tab that is not inside double quotes.  A '\"'
+# pair never opens or closes a quoted section.
+_OPTIONS_RE = re.compile(r'(?:\\"|"(?:\\"|[^"])*"?|[^ \t"])*')
+
 
 class AuthKeyLine(object):
+    __slots__ = ('base64', 'comment', 'options', 'keytype', 'source', '_str')
+
     def __init__(self, source, keytype=None, base64=None,
                  comment=None, options=None):
         self.base64 = base64
@@ -73,11 +102,21 @@ class AuthKeyLine(object):
         self.options = options
         self.keytype = keytype
         self.source = source
+        # Rendered form, built on first use by __str__.  Entries are not
+        # modified after parsing, so it never needs invalidating.  Lines
+        # without any key fields (comments, blanks, invalid entries) render
+        # as their source, so they need no rendering at all.
+        if keytype or base64 or comment or options:
+            self._str = None
+        else:
+            self._str = source
 
     def valid(self):
         return (self.base64 and self.keytype)
 
     def __str__(self):
+        if self._str is not None:
+            return self._str
         toks = []
         if self.options:
             toks.append(self.options)
@@ -88,9 +127,10 @@ class AuthKeyLine(object):
         if self.comment:
             toks.append(self.comment)
         if not toks:
-            return self.source
+            self._str = self.source
         else:
-            return ' '.join(toks)
+            self._str = ' '.join(toks)
+        return self._str
 
 
 class AuthKeyLineParser(object):
@@ -113,27 +153,20 @@ class AuthKeyLineParser(object):
      case-insensitive):
     """
 
-    def _extract_options(self, ent):
+    @staticmethod
+    def _extract_options(ent, first_tok=None):
         """
         The options (if present) consist of comma-separated option specifica-
          tions.  No spaces are permitted, except within double quotes.
          Note that option keywords are case-insensitive.
-        """
-        quoted = False
-        i = 0
-        while (i < len(ent) and
-               ((quoted) or (ent[i] not in (" ", "\t")))):
-            curc = ent[i]
-            if i + 1 >= len(ent):
-                i = i + 1
-                break
-            nextc = ent[i + 1]
-            if curc == "\\" and nextc == '"':
-                i = i + 1
-            elif curc == '"':
-                quoted = not quoted
-            i = i + 1
 
+        first_tok, if given, is the first whitespace separated token of ent.
+        When it holds no quotes the options end right after it and ent does
+        not need to be scanned again.
+        """
+        i = len(first_tok) if first_tok else 0
+        if not i or '"' in first_tok or ent[i:i + 1] not in ("", " ", "\t"):
+            i = _OPTIONS_RE.match(ent).end()
         options = ent[0:i]
 
         # Return the rest of the string in 'remain'
@@ -141,78 +174,125 @@ class AuthKeyLineParser(object):
         return (options, remain)
 
     def parse(self, src_line, options=None):
-        # modeled after opensshes auth2-pubkey.c:user_key_allowed2
-        line = src_line.rstrip("\r\n")
-        if line.startswith("#") or line.strip() == '':
+        # Comments and blank lines are passed through untouched; catch them
+        # before doing any string copies or cache lookups
+        if not src_line or src_line[0] == "#" or src_line.isspace():
+            return AuthKeyLine(src_line)
+
+        if len(src_line) > _PARSE_CACHE_MAX_LINE:
+            fields = _parse_fields(src_line, options)
+        else:
+            fields = _parse_fields_cached(src_line, options)
+        if fields is None:
             return AuthKeyLine(src_line)
 
-        def parse_ssh_key(ent):
-            # return ketype, key, [comment]
-            toks = ent.split(None, 2)
-            if len(toks) < 2:
-                raise TypeError("To few fields: %s" % len(toks))
-            if toks[0] not in VALID_KEY_TYPES:
-                raise TypeError("Invalid keytype %s" % toks[0])
+        (keytype, base64, comment, options) = fields
+        return AuthKeyLine(src_line, keytype=keytype, base64=base64,
+                           comment=comment, options=options)
 
-            # valid key type and 2 or 3 fields:
-            if len(toks) == 2:
-                # no comment in line
-                toks.append("")
 
-            return toks
+def _split_ssh_key(toks):
+    """Return [keytype, base64, comment] from toks, or None if not a key.
 
-        ent = line.strip()
-        try:
-            (keytype, base64, comment) = parse_ssh_key(ent)
-        except TypeError:
-            (keyopts, remain) = self._extract_options(ent)
-            if options is None:
-                options = keyopts
+    toks is the result of splitting a key entry with split(None, 2)."""
+    if len(toks) < 2 or toks[0] not in _VALID_KEY_TYPES_SET:
+        return None
 
-            try:
-                (keytype, base64, comment) = parse_ssh_key(remain)
-            except TypeError:
-                return AuthKeyLine(src_line)
+    # valid key type and 2 or 3 fields:
+    if len(toks) == 2:
+        # no comment in line
+        toks.append("")
 
-        return AuthKeyLine(src_line, keytype=keytype, base64=base64,
-                           comment=comment, options=options)
+    return toks
+
+
+def _parse_fields(src_line, options=None):
+    """Split an authorized_keys line into its fields.
+
+    Returns a (keytype, base64, comment, options) tuple, or None when the
+    line is not a valid key entry.  Comment and blank lines are expected to
+    have been filtered out by the caller.  This is kept free of any parser
+    state so that its results can be memoized.
+    """
+    # modeled after opensshes auth2-pubkey.c:user_key_allowed2
+    ent = src_line.strip()
+    head = ent.split(None, 2)
+    toks = _split_ssh_key(head)
+    if toks is None:
+        (keyopts, remain) = AuthKeyLineParser._extract_options(
+            ent, head[0] if head else None)
+        if options is None:
+            options = keyopts
+
+        toks = _split_ssh_key(remain.split(None, 2))
+        if toks is None:
+            return None
+
+    (keytype, base64, comment) = toks
+    # Key types and option strings repeat heavily across entries, so share
+    # a single copy of each rather than keeping one per line
+    keytype = sys.intern(keytype)
+    if options:
+        options = sys.intern(options)
+    return (keytype, base64, comment, options)
+
+
+# AuthKeyLine objects are handed out fresh on every parse, only the
+# immutable field tuples are shared between identical lines.
+_parse_fields_cached = functools.lru_cache(maxsize=4096)(_parse_fields)
 
 
 def parse_authorized_keys(fnames):
-    lines = []
-    parser = AuthKeyLineParser()
+    parse = AuthKeyLineParser().parse
     contents = []
     for fname in fnames:
         try:
-            if os.path.isfile(fname):
-                lines = util.load_file(fname).splitlines()
-                for line in lines:
-                    contents.append(parser.parse(line))
+            # Only regular files are read.  FIFOs, devices and directories
+            # are skipped without being opened, as opening them may block or
+            # have side effects.
+            if not stat.S_ISREG(os.stat(fname).st_mode):
+                continue
+            # Open without blocking in case the path was swapped for a FIFO
+            # after the check above, and check the type again on the open
+            # descriptor to close that race
+            fd = os.open(fname, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno not in _NOT_A_FILE_ERRNOS:
+                util.logexc(LOG, "Error reading lines from %s", fname)
+            continue
+        try:
+            if not stat.S_ISREG(os.fstat(fd).st_mode):
+                continue
+            # Stream the file rather than holding it both as a single
+            # string and as a list of lines
+            with os.fdopen(fd, 'r', encoding='utf-8', closefd=False) as fh:
+                contents.extend([parse(line.rstrip('\n')) for line in fh])
         except (IOError, OSError):
             util.logexc(LOG, "Error reading lines from %s", fname)
+        finally:
+            os.close(fd)
 
     return contents
 
 
 def update_authorized_keys(old_entries, keys):
-    to_add = list([k for k in keys if k.valid()])
+    # Index the new keys by base64; the last one given for a key wins
+    keys_by_b64 = dict((k.base64, k) for k in keys if k.base64)
+    replaced = set()
     for i in range(0, len(old_entries)):
         ent = old_entries[i]
         if not ent.valid():
             continue
-        # Replace those with the same base64
-        for k in keys:
-            if k.base64 == ent.base64:
-                # Replace it with our better one
-                ent = k
-                # Don't add it later
-                if k in to_add:
-                    to_add.remove(k)
-        old_entries[i] = ent
-
-    # Now append any entries we did not match above
-    for key in to_add:
-        old_entries.append(key)
+        # Replace those with the same base64 with our better one
+        key = keys_by_b64.get(ent.base64)
+        if key is not None:
+            old_entries[i] = key
+            replaced.add(ent.base64)
+
+    # Now append any entries we did not match above, once per base64
+    for b64, key in keys_by_b64.items():
+        if b64 not in replaced and key.valid():
+            old_entries.append(key)
 
     # Now format them back to strings...
     lines = [str(b) for b in old_entries]
@@ -235,14 +315,18 @@ def render_authorizedkeysfile_paths(value, homedir, username):
     # The following tokens are defined: %% is replaced by a literal
     # '%', %h is replaced by the home directory of the user being
     # authenticated and %u is replaced by the username of that user.
-    macros = (("%h", homedir), ("%u", username), ("%%", "%"))
+    macros = {"%h": homedir, "%u": username, "%%": "%"}
+
+    def expand(match):
+        return macros[match.group(0)]
+
     if not value:
         value = "%h/.ssh/authorized_keys"
     paths = value.split()
     rendered = []
     for path in paths:
-        for macro, field in macros:
-            path = path.replace(macro, field)
+        # Expand all tokens in one pass, so expanded text is never rescanned
+        path = _AUTHKEYSFILE_TOKEN_RE.sub(expand, path)
         if not path.startswith("/"):
             path = os.path.join(homedir, path)
         rendered.append(path)
@@ -279,10 +363,8 @@ def setup_user_keys(keys, username, options=None):
         util.chownbyid(ssh_dir, pwent.pw_uid, pwent.pw_gid)
 
     # Turn the 'update' keys given into actual entries
-    parser = AuthKeyLineParser()
-    key_entries = []
-    for k in keys:
-        key_entries.append(parser.parse(str(k), options=options))
+    parse = AuthKeyLineParser().parse
+    key_entries = [parse(str(k), options=options) for k in keys]
 
     # Extract the old and make the new
     (auth_key_fn, auth_key_entries) = extract_authorized_keys(username)
@@ -294,6 +376,8 @@ def setup_user_keys(keys, username, options=None):
 
 
 class SshdConfigLine(object):
+    __slots__ = ('line', '_key', 'value')
+
     def __init__(self, line, k=None, v=None):
         self.line = line
         self._key = k
@@ -333,24 +417,47 @@ def parse_ssh_config_lines(lines):
         if not line or line.startswith("#"):
             ret.append(SshdConfigLine(line))
             continue
-        try:
-            key, val = line.split(None, 1)
-        except ValueError:
-            key, val = line.split('=', 1)
+        key, val = _split_ssh_config_line(line)
         ret.append(SshdConfigLine(line, key, val))
     return ret
 
 
+def _split_ssh_config_line(line):
+    # Split a stripped, non-comment line into its keyword and argument
+    try:
+        key, val = line.split(None, 1)
+    except ValueError:
+        key, val = line.split('=', 1)
+    return key, val
+
+
 def parse_ssh_config_map(fname):
-    lines = parse_ssh_config(fname)
-    if not lines:
+    """Return a {lowercase key: value} dict of the sshd config in fname.
+
+    The result is cached per file and reused for as long as the file's
+    stat signature (mtime, size and inode) does not change."""
+    try:
+        st = os.stat(fname)
+    except OSError:
         return {}
+    if not stat.S_ISREG(st.st_mode):
+        return {}
+    signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+    cached = _SSHD_CFG_MAP_CACHE.get(fname)
+    if cached is not None and cached[0] == signature:
+        return dict(cached[1])
+
+    # Build the map directly, without SshdConfigLine objects for every line
     ret = {}
-    for line in lines:
-        if not line.key:
+    for line in util.load_file(fname).splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
             continue
-        ret[line.key] = line.value
-    return ret
+        key, val = _split_ssh_config_line(line)
+        # Keywords are case-insensitive
+        ret[key.lower()] = val
+    _SSHD_CFG_MAP_CACHE[fname] = (signature, ret)
+    return dict(ret)
 
 
 def update_ssh_config(updates, fname=DEF_SSHD_CFG):
@@ -365,6 +472,8 @@ def update_ssh_config(updates, fname=DEF_SSHD_CFG):
             fname, "\n".join(
                 [str(line) for line in lines]
             ) + "\n", preserve_mode=True)
+        # The rewrite may keep size, inode and (coarse) mtime unchanged
+        _SSHD_CFG_MAP_CACHE.pop(fname, None)
     return len(changed) != 0
 
 
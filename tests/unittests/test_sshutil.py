@@ -1,5 +1,6 @@
 # This file is part of cloud-init. See LICENSE file for license information.
 
+import os
 from collections import namedtuple
 from unittest.mock import patch
 
@@ -326,6 +327,18 @@ class TestAuthKeyLineParser(test_helpers.CiTestCase):
             self.assertEqual(key.comment, comment)
             self.assertEqual(key.keytype, ktype)
 
+    def test_extract_options_quoting(self):
+        """Options end at the first unquoted space or tab."""
+        extract = ssh_util.AuthKeyLineParser._extract_options
+        self.assertEqual(
+            ('no-pty,command="a b\tc"', 'rsa AAAA'),
+            extract('no-pty,command="a b\tc"\trsa AAAA'))
+        self.assertEqual(
+            ('from=\\"x', 'y" rsa'), extract('from=\\"x y" rsa'))
+        self.assertEqual(('opt="unterminated x', ''),
+                         extract('opt="unterminated x'))
+        self.assertEqual(('', 'rsa AAAA'), extract(' rsa AAAA'))
+
     def test_parse_with_options_passed_in(self):
         # test key line with key type and base64 only
         parser = ssh_util.AuthKeyLineParser()
@@ -345,6 +358,20 @@ class TestAuthKeyLineParser(test_helpers.CiTestCase):
 
         self.assertFalse(key.valid())
 
+    def test_parse_same_line_returns_distinct_entries(self):
+        """Repeated lines are parsed alike but into separate objects."""
+        parser = ssh_util.AuthKeyLineParser()
+        line = ' '.join(("rsa", VALID_CONTENT['rsa'], "user@host"))
+
+        key1 = parser.parse(line)
+        key2 = ssh_util.AuthKeyLineParser().parse(line)
+        self.assertIsNot(key1, key2)
+        self.assertEqual(str(key1), str(key2))
+
+        key3 = parser.parse(line, options="no-pty")
+        self.assertEqual("no-pty", key3.options)
+        self.assertIsNone(parser.parse(line).options)
+
 
 class TestUpdateAuthorizedKeys(test_helpers.CiTestCase):
 
@@ -387,6 +414,48 @@ class TestUpdateAuthorizedKeys(test_helpers.CiTestCase):
 
         self.assertEqual(expected, found)
 
+    def test_unmatched_new_keys_are_appended(self):
+        """new entries that match nothing are added after the old ones."""
+        orig_entries = [
+            '# a comment',
+            ' '.join(('rsa', VALID_CONTENT['rsa'], 'orig_comment1')),
+            ' '.join(('rsa', VALID_CONTENT['rsa'], 'orig_comment2'))]
+
+        new_entries = [
+            ' '.join(('ssh-ed25519', VALID_CONTENT['ssh-ed25519'], 'new1')),
+            ' '.join(('rsa', VALID_CONTENT['rsa'], 'new_comment1'))]
+
+        expected = '\n'.join(
+            [orig_entries[0], new_entries[1], new_entries[1],
+             new_entries[0]]) + '\n'
+
+        parser = ssh_util.AuthKeyLineParser()
+        found = ssh_util.update_authorized_keys(
+            [parser.parse(p) for p in orig_entries],
+            [parser.parse(p) for p in new_entries])
+
+        self.assertEqual(expected, found)
+
+    def test_duplicate_new_keys_added_once(self):
+        """new entries with the same base64 are only added once."""
+        orig_entries = [
+            ' '.join(('dsa', VALID_CONTENT['dsa'], 'orig_comment1'))]
+
+        new_entries = [
+            ' '.join(('rsa', VALID_CONTENT['rsa'], 'new_comment1')),
+            ' '.join(('ssh-ed25519', VALID_CONTENT['ssh-ed25519'], 'new2')),
+            ' '.join(('rsa', VALID_CONTENT['rsa'], 'new_comment3'))]
+
+        expected = '\n'.join(
+            [orig_entries[0], new_entries[2], new_entries[1]]) + '\n'
+
+        parser = ssh_util.AuthKeyLineParser()
+        found = ssh_util.update_authorized_keys(
+            [parser.parse(p) for p in orig_entries],
+            [parser.parse(p) for p in new_entries])
+
+        self.assertEqual(expected, found)
+
 
 class TestParseSSHConfig(test_helpers.CiTestCase):
 
@@ -456,6 +525,49 @@ class TestParseSSHConfig(test_helpers.CiTestCase):
         self.assertEqual('bar', ret[0].value)
 
 
+class TestParseSSHConfigMap(test_helpers.CiTestCase):
+
+    def test_not_a_file(self):
+        self.assertEqual(
+            {}, ssh_util.parse_ssh_config_map(self.tmp_path('missing')))
+
+    def test_comments_and_case(self):
+        mycfg = self.tmp_path('sshd_config')
+        util.write_file(
+            mycfg, "# Foo bar\n\n  PasswordAuthentication yes\nUseDNS=no\n")
+        self.assertEqual(
+            {'passwordauthentication': 'yes', 'usedns': 'no'},
+            ssh_util.parse_ssh_config_map(mycfg))
+
+    def test_reparsed_only_when_file_changes(self):
+        mycfg = self.tmp_path('sshd_config')
+        util.write_file(mycfg, "# comment\nAuthorizedKeysFile /a/keys\n")
+        with patch('cloudinit.ssh_util.util.load_file',
+                   wraps=util.load_file) as m_load_file:
+            expected = {'authorizedkeysfile': '/a/keys'}
+            self.assertEqual(expected, ssh_util.parse_ssh_config_map(mycfg))
+            self.assertEqual(expected, ssh_util.parse_ssh_config_map(mycfg))
+            self.assertEqual(1, m_load_file.call_count)
+
+            util.write_file(mycfg, "AuthorizedKeysFile /a/keys /b/keys\n")
+            self.assertEqual(
+                {'authorizedkeysfile': '/a/keys /b/keys'},
+                ssh_util.parse_ssh_config_map(mycfg))
+            self.assertEqual(2, m_load_file.call_count)
+
+    def test_update_ssh_config_drops_cached_map(self):
+        mycfg = self.tmp_path('sshd_config')
+        util.write_file(mycfg, "MyKey AAA\n")
+        self.assertEqual(
+            {'mykey': 'AAA'}, ssh_util.parse_ssh_config_map(mycfg))
+        # Same size rewrite, with the stat signature kept identical
+        st = os.stat(mycfg)
+        self.assertTrue(ssh_util.update_ssh_config({"MyKey": "BBB"}, mycfg))
+        os.utime(mycfg, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(
+            {'mykey': 'BBB'}, ssh_util.parse_ssh_config_map(mycfg))
+
+
 class TestUpdateSshConfigLines(test_helpers.CiTestCase):
     """Test the update_ssh_config_lines method."""
     exlines = [
@@ -570,6 +682,54 @@ class TestBasicAuthorizedKeyParse(test_helpers.CiTestCase):
             ssh_util.render_authorizedkeysfile_paths(
                 "%h/.keys", "/homedirs/bobby", "bobby"))
 
+    def test_literal_percent(self):
+        self.assertEqual(
+            ["/keys/%h/bobby%"],
+            ssh_util.render_authorizedkeysfile_paths(
+                "/keys/%%h/%u%%", "/home/bobby", "bobby"))
+
+    def test_tokens_in_values_not_expanded(self):
+        self.assertEqual(
+            ["/home/%u/.keys"],
+            ssh_util.render_authorizedkeysfile_paths(
+                "%h/.keys", "/home/%u", "bobby"))
+
+
+class TestParseAuthorizedKeys(test_helpers.CiTestCase):
+
+    def test_lines_round_trip(self):
+        """Keys are read from regular files only, without line endings."""
+        key_line = ' '.join(('rsa', VALID_CONTENT['rsa'], 'user@host'))
+        keys1 = self.tmp_path('keys1')
+        util.write_file(keys1, "# comment\r\n\n%s\n" % key_line)
+        keys2 = self.tmp_path('keys2')
+        util.write_file(keys2, key_line)
+
+        fifo = self.tmp_path('fifo')
+        os.mkfifo(fifo)
+        device = self.tmp_path('device')
+        os.symlink('/dev/zero', device)
+        loop = self.tmp_path('loop')
+        os.symlink(loop, loop)
+        not_a_dir = os.path.join(keys2, 'authorized_keys')
+
+        with patch('cloudinit.ssh_util.util.logexc') as m_logexc:
+            with patch('cloudinit.ssh_util.os.open',
+                       wraps=os.open) as m_open:
+                entries = ssh_util.parse_authorized_keys(
+                    [keys1, self.tmp_path('missing'), self.tmp_dir(), fifo,
+                     device, loop, not_a_dir, keys2])
+        m_logexc.assert_not_called()
+        # Non-regular files are never opened
+        self.assertEqual([keys1, keys2],
+                         [c[0][0] for c in m_open.call_args_list])
+
+        self.assertEqual(
+            ['# comment', '', key_line, key_line],
+            [str(e) for e in entries])
+        self.assertEqual([False, False, True, True],
+                         [bool(e.valid()) for e in entries])
+
 
 class TestMultipleSshAuthorizedKeysFile(test_helpers.CiTestCase):
 